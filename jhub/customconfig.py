@@ -23,10 +23,15 @@ import subprocess
 import warnings
 import asyncio
 import shutil
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Dict
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple
 
 import jinja2
+from prometheus_client import Gauge
 import kubernetes_asyncio as k8s
 from kubernetes_asyncio.client.models import (
     V1Service, 
@@ -59,6 +64,14 @@ DEFAULT_JLAB_IMAGES = json.loads(
 GPU_MODEL_DESCRIPTION = json.loads(
   os.environ.get("GPU_MODEL_DESCRIPTION", '[]')
 )
+NFS_USAGE_INDEXER = os.environ.get("NFS_USAGE_INDEXER", "true").lower() in ["true", "yes", "y"]
+NFS_USAGE_REFRESH_INTERVAL = int(os.environ.get("NFS_USAGE_REFRESH_INTERVAL", 3600))
+NFS_USAGE_FULL_RESCAN_INTERVAL = int(os.environ.get("NFS_USAGE_FULL_RESCAN_INTERVAL", 86400))
+NFS_USAGE_MAX_WORKERS = int(os.environ.get("NFS_USAGE_MAX_WORKERS", 4))
+NFS_USAGE_MAX_ENTRIES_PER_SECOND = int(os.environ.get("NFS_USAGE_MAX_ENTRIES_PER_SECOND", 2000))
+NFS_USAGE_SOFT_LIMITS_GB = json.loads(
+  os.environ.get("NFS_USAGE_SOFT_LIMITS_GB", '{}')
+)
 CONFIGMAP_MOUNT_PATH = Path(
     os.environ.get(
         "CONFIGMAP_MOUNT_PATH", 
@@ -66,6 +79,15 @@ CONFIGMAP_MOUNT_PATH = Path(
     )
 )
 
+# Python modules shipped with the configmap, in a subdirectory not to be loaded as config
+sys.path.insert(0, str(CONFIGMAP_MOUNT_PATH / "lib"))
+from placement import (
+    NodeRecord,
+    PodRecord,
+    spawn_config_from_form,
+    count_accelerators,
+)
+
 # Virtual Kubelet Dispatcher configuration
 ENABLE_VKD = os.environ.get("ENABLE_VKD", "").lower() in ["true", "yes", "y"]
 VKD_SIDECAR_IMAGE = os.environ.get("VKD_SIDECAR_IMAGE", "harbor.cloud.infn.it/testbed-dm/vkd-dev:v0.0")
@@ -222,22 +244,401 @@ class SplashManager:
         
 
 
+################################################################################
+## NFS usage indexer
+
+NFS_USAGE_BYTES = Gauge(
+    "jupyterhub_nfs_usage_bytes",
+    "Disk usage of the top-level directories of the shared NFS volume",
+    ["tree"],
+)
+
+NFS_USAGE_SOFT_LIMIT_BYTES = Gauge(
+    "jupyterhub_nfs_usage_soft_limit_bytes",
+    "Soft limit on the disk usage of the top-level directories of the shared NFS volume",
+    ["tree"],
+)
+
+
+class _DirUsage(NamedTuple):
+    """
+    Internal. Cached usage of the files directly contained in a directory,
+    and names of its subdirectories.
+    """
+    mtime_ns: int
+    scanned_at: float
+    files_bytes: int
+    subdirs: Tuple[str, ...]
+
+
+class NfsUsageIndexer:
+    """
+    Keeps the disk usage of the top-level directories ("trees") of the NFS volume
+    (`user-<name>`, `shared-<group>`, `envs`, `public`, ...) up to date in a
+    background thread.
+
+    All the trees are walked once in parallel at startup, then refreshed one at a
+    time, trees marked as active first. Trees in use (marked as running within
+    `in_use_timeout` seconds) are walked entirely at each refresh, since files
+    growing in place do not modify the mtime of their directory. In the other trees,
+    a directory whose mtime did not change reuses the cached size of its files,
+    unless older than `full_rescan_interval`.
+    The number of directory entries read per second is capped by
+    `max_entries_per_second`, shared by all the workers (including those of the
+    startup walk), to keep the indexer from competing with the users' own NFS traffic.
+    """
+    def __init__(
+        self,
+        root: Path,
+        refresh_interval: int = 3600,
+        full_rescan_interval: int = 86400,
+        max_workers: int = 4,
+        max_entries_per_second: int = 2000,
+        soft_limits_gb: Optional[Dict[str, float]] = None,
+        in_use_timeout: int = 600,
+    ):
+        self._root = Path(root)
+        self._refresh_interval = refresh_interval
+        self._full_rescan_interval = full_rescan_interval
+        self._max_workers = max_workers
+        self._max_entries_per_second = max_entries_per_second
+        self._soft_limits_gb = soft_limits_gb or {}
+        self._in_use_timeout = in_use_timeout
+
+        self._dirs = {}        # tree -> {path relative to the tree: _DirUsage}
+        self._linked_trees = set()  # trees containing files with several hard links
+        self._usage = {}       # tree -> bytes
+        self._indexed_at = {}  # tree -> time of the last completed indexing
+        self._active_at = {}   # tree -> time of the last spawn or stop
+        self._running_at = {}  # tree -> last time a server mounting it was seen running
+        self._lock = threading.Lock()
+        self._next_slot = 0.
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="nfs-usage-indexer", daemon=True)
+            self._thread.start()
+
+    def usage(self, tree: str) -> Optional[int]:
+        """
+        Usage in bytes of `tree`, None if not indexed yet.
+        """
+        return self._usage.get(tree)
+
+    def soft_limit(self, tree: str) -> Optional[float]:
+        """
+        Soft limit in bytes of `tree`, looked up by name (e.g. `shared-mygroup`) first,
+        then by kind (e.g. `shared`). None if no limit is configured.
+        """
+        limit_gb = self._soft_limits_gb.get(tree, self._soft_limits_gb.get(tree.split("-")[0]))
+        if limit_gb is None:
+            return None
+        return float(limit_gb) * 1e9
+
+    def mark_running(self, tree: str):
+        """
+        Record that `tree` is mounted by a running server, so that its files may grow.
+        """
+        self._running_at[tree] = time.time()
+
+    def in_use(self, tree: str) -> bool:
+        return time.time() - self._running_at.get(tree, 0.) < self._in_use_timeout
+
+    def mark_active(self, tree: str):
+        """
+        Schedule `tree` for a refresh ahead of the others.
+        """
+        self._active_at[tree] = time.time()
+
+    def _throttle(self, n_entries: int):
+        if self._max_entries_per_second <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._next_slot = max(self._next_slot, now) + n_entries / self._max_entries_per_second
+            delay = self._next_slot - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _list_trees(self):
+        with os.scandir(self._root) as entries:
+            return [
+                entry.name for entry in entries
+                if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False)
+            ]
+
+    def _index_tree(self, tree: str):
+        """
+        Walk `tree`, reusing the cached directories not modified since the last walk
+        unless the tree is in use, was marked as active since, or contains hard links.
+
+        Files with several hard links (e.g. conda environments linked to the package
+        cache) are counted once per tree. Since a cached directory cannot tell whether
+        its files got linked elsewhere meanwhile, trees with hard links are walked entirely.
+        The cache is keyed on the paths relative to the tree and is not kept for
+        trees that will be walked entirely at the next refresh anyway.
+        """
+        full_walk = (
+            self.in_use(tree) 
+            or tree in self._linked_trees
+            or self._active_at.get(tree, 0.) > self._indexed_at.get(tree, 0.)
+        )
+        cache = {} if full_walk else self._dirs.get(tree, {})
+        keep_cache = not (self.in_use(tree) or tree in self._linked_trees)
+        new_cache = {} if keep_cache else None
+        inodes = set()
+        total = 0
+        base = os.path.join(self._root, tree)
+        stack = [""]
+        while stack:
+            relpath = stack.pop()
+            path = os.path.join(base, relpath)
+            try:
+                mtime_ns = os.stat(path, follow_symlinks=False).st_mtime_ns
+            except OSError:
+                continue
+
+            cached = cache.get(relpath)
+            if (
+                cached is not None
+                and cached.mtime_ns == mtime_ns
+                and time.time() - cached.scanned_at < self._full_rescan_interval
+            ):
+                self._throttle(1)
+                if new_cache is not None:
+                    new_cache[relpath] = cached
+                total += cached.files_bytes
+                stack.extend(os.path.join(relpath, name) for name in cached.subdirs)
+                continue
+
+            try:
+                with os.scandir(path) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+
+            self._throttle(len(entries) + 1)
+            files_bytes = 0
+            subdirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                        continue
+
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_nlink > 1:
+                        if (stat.st_dev, stat.st_ino) in inodes:
+                            continue
+                        inodes.add((stat.st_dev, stat.st_ino))
+                    files_bytes += stat.st_blocks * 512
+                except OSError:
+                    continue
+
+            if new_cache is not None:
+                new_cache[relpath] = _DirUsage(mtime_ns, time.time(), files_bytes, tuple(subdirs))
+            total += files_bytes
+            stack.extend(os.path.join(relpath, name) for name in subdirs)
+
+        if len(inodes) > 0 and not full_walk:
+            # Cached directories may hold other links to the inodes found: walk again
+            self._linked_trees.add(tree)
+            return self._index_tree(tree)
+
+        if len(inodes) > 0:
+            self._linked_trees.add(tree)
+        else:
+            self._linked_trees.discard(tree)
+
+        if new_cache is None or tree in self._linked_trees:
+            self._dirs.pop(tree, None)
+        else:
+            self._dirs[tree] = new_cache
+        self._usage[tree] = total
+        self._indexed_at[tree] = time.time()
+
+        NFS_USAGE_BYTES.labels(tree=tree).set(total)
+        soft_limit = self.soft_limit(tree)
+        if soft_limit is not None:
+            NFS_USAGE_SOFT_LIMIT_BYTES.labels(tree=tree).set(soft_limit)
+
+        logging.debug(f"NFS usage of {tree}: {total/1e9:.2f} GB")
+
+    def _forget_tree(self, tree: str):
+        for mapping in (self._dirs, self._usage, self._indexed_at, self._active_at, self._running_at):
+            mapping.pop(tree, None)
+        self._linked_trees.discard(tree)
+        for gauge in (NFS_USAGE_BYTES, NFS_USAGE_SOFT_LIMIT_BYTES):
+            try:
+                gauge.remove(tree)
+            except KeyError:
+                pass
+
+    def _next_tree(self, trees):
+        """
+        Return the tree to refresh next and the time to wait before refreshing it.
+        Trees active after their last indexing come first, then the least recently indexed.
+        """
+        now = time.time()
+        def priority(tree):
+            indexed_at = self._indexed_at.get(tree, 0.)
+            active = self._active_at.get(tree, 0.) > indexed_at
+            return (not active, indexed_at)
+
+        tree = min(trees, key=priority)
+        indexed_at = self._indexed_at.get(tree, 0.)
+        if self._active_at.get(tree, 0.) > indexed_at:
+            return tree, 0.
+        return tree, max(0., indexed_at + self._refresh_interval - now)
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                list(executor.map(self._index_tree, self._list_trees()))
+        except Exception:
+            logging.error("NFS usage indexer: initial walk failed")
+            logging.error(traceback.format_exc())
+        else:
+            logging.info(f"NFS usage indexer: initial walk completed in {time.time() - start_time:.0f} s")
+
+        while True:
+            try:
+                trees = self._list_trees()
+                for tree in set(self._usage.keys()) - set(trees):
+                    self._forget_tree(tree)
+
+                if len(trees) == 0:
+                    time.sleep(60)
+                    continue
+
+                tree, delay = self._next_tree(trees)
+                if delay > 0:
+                    # Wake up periodically to serve trees marked as active meanwhile
+                    time.sleep(min(delay, 30))
+                    continue
+
+                self._index_tree(tree)
+            except Exception:
+                logging.error("NFS usage indexer: refresh failed")
+                logging.error(traceback.format_exc())
+                time.sleep(60)
+
+
+
+################################################################################
+## Pod templates
+
+SPAWN_FORM_CPUS = [1, 2, 3, 4, 8]
+SPAWN_FORM_MEM_SIZES = [2, 4, 8]
+
+_form_profile_choices = (
+    set(DEFAULT_JLAB_IMAGES.values()),
+    {str(cpu) for cpu in SPAWN_FORM_CPUS},
+    {f"{mem}G" for mem in SPAWN_FORM_MEM_SIZES},
+    {"none"} | {f"gpu:{acc['name']}:1" for acc in GPU_MODEL_DESCRIPTION},
+)
+
+_pod_profile_templates = {}
+
+
+def pod_profile_template(formdata):
+    """
+    Return the profile (image, cpu, memory, accelerator) selected in the spawn form
+    and its template: the options and the KubeSpawner attributes (resources, 
+    tolerations, node affinity) computed by spawn_config_from_form.
+
+    Templates are built once for the profiles offered by the form (images of 
+    DEFAULT_JLAB_IMAGES and the cpu, memory and accelerator choices), so that the cache 
+    stays bounded; other profiles (e.g. custom images) are built at each spawn.
+    The configuration is read at hub startup and the hub is restarted on changes,
+    hence the cache needs no invalidation. Templates are shared and must not be modified.
+    """
+    profile = tuple(''.join(formdata[key]) for key in ('img', 'cpu', 'mem', 'gpu'))
+    template = _pod_profile_templates.get(profile)
+    if template is None:
+        template = spawn_config_from_form(formdata, GPU_MODEL_DESCRIPTION)
+        if all(choice in choices for choice, choices in zip(profile, _form_profile_choices)):
+            _pod_profile_templates[profile] = template
+
+    return profile, template
+
+
+class PodPatch(NamedTuple):
+    """
+    User-dependent part of the pod description, collected once per spawn.
+    """
+    username: str
+    groups: Tuple[str, ...]
+    privileges: Tuple[str, ...]
+    storage: Tuple[str, ...]
+
+
 ################################################################################
 ## Helper static functions
-def _prefer_accelerator(node_selectors: Dict[str, str], weight=1):
+async def _list_raw(list_function, **kwargs):
     """
-    Internal. Format the preference for an accelerator as an nodeAffinity preference.
+    Internal. Call a kubernetes_asyncio `list_*` function without deserializing
+    the response into the model classes, returning the decoded JSON body.
     """
-    return dict(
-        weight=weight,
-        preference=dict(
-            matchExpressions=[
-                {'key': label, 'operator': "In", "values": [value]}
-                for label, value in node_selectors.items()
-                ]
-            )
+    response = await list_function(_preload_content=False, **kwargs)
+    try:
+        return json.loads(await response.read())
+    finally:
+        response.release()
+
+
+async def _list_accelerator_nodes() -> List[NodeRecord]:
+    """
+    Internal. List the nodes labeled with an accelerator (other than "none"),
+    projected onto the few fields read by InfnSpawner.get_accelerators.
+    """
+    async with kubernetes_api() as k:
+        body = await _list_raw(
+            k.list_node,
+            label_selector="accelerator,accelerator!=none",
         )
 
+    return [
+        NodeRecord(
+            name=node['metadata']['name'],
+            accelerator=node['metadata'].get('labels', {}).get('accelerator', 'none'),
+            allocatable=node.get('status', {}).get('allocatable') or {},
+            capacity=node.get('status', {}).get('capacity') or {},
+        )
+        for node in body.get('items') or []
+    ]
+
+
+async def _list_scheduled_pods(namespace: str) -> List[PodRecord]:
+    """
+    Internal. List the pods of `namespace` bound to a node and not terminated,
+    projected onto their node name and container resources.
+    """
+    async with kubernetes_api() as k:
+        body = await _list_raw(
+            k.list_namespaced_pod,
+            namespace=namespace,
+            field_selector="spec.nodeName!=,status.phase!=Succeeded,status.phase!=Failed",
+        )
+
+    records = []
+    for pod in body.get('items') or []:
+        spec = pod.get('spec', {})
+        resources = []
+        for container in spec.get('containers') or []:
+            container_resources = container.get('resources') or {}
+            if container_resources.get('limits') is not None:
+                resources.append(container_resources['limits'])
+            else:
+                resources.append(container_resources.get('requests') or {})
+        records.append(PodRecord(node_name=spec.get('nodeName'), resources=resources))
+
+    return records
+
 
 
 
@@ -263,106 +664,41 @@ class InfnSpawner(KubeSpawner):
       the jupyterhub helm chart to work.
       """
 
-      async with kubernetes_api() as k:
-        nodes = await k.list_node()
-
-      pprint (nodes)
-
-      # Copy the list
-      return_list = [dict(**acc, count=0) for acc in GPU_MODEL_DESCRIPTION]
-
-      if status_key in ['allocatable', 'capacity']:
-        for node in nodes.items:
-          accelerator = node.metadata.labels.get("accelerator", "none")
-          if accelerator != "none":
-            if hasattr(node.status, status_key):
-              for return_item in return_list:
-                if accelerator == return_item['name']:
-                  ext_res = return_item.get("extended_resource", default_extended_resource)
-                  node_count = getattr(node.status, status_key).get(ext_res, 0)
-                  return_item['count'] += int(node_count)
-
-      elif status_key in ['allocated']:
-        async with kubernetes_api() as k:
-          pods = await k.list_namespaced_pod(namespace=JHUB_NAMESPACE)
-
-        node_dict = {node.metadata.name: node for node in nodes.items}
-
-        for pod in pods.items:
-          node = node_dict[pod.spec.node_name]
-          accelerator = node.metadata.labels.get("accelerator", "none")
-          if accelerator != "none":
-            for return_item in return_list:
-              if accelerator == return_item['name']:
-                ext_res = return_item.get("extended_resource", default_extended_resource)
-                for container in pod.spec.containers:
-                  if container.resources.limits is not None:
-                    container_count = container.resources.limits.get(ext_res, 0)
-                  elif container.resources.requests is not None:
-                    container_count = container.resources.requests.get(ext_res, 0)
-                  else:
-                    container_count = 0
-                  return_item['count'] += int(container_count)
-        
-      else:
-        raise KeyError(f"Unexpected status_key {status_key}")
-            
-      return return_list
-      
-
-    async def options_from_form(self, formdata):
-        options = {}
-        options['img'] = formdata['img']
-        container_image = ''.join(formdata['img'])
-        print("SPAWN: " + container_image + " IMAGE" )
-        self.image = container_image
-
-        options['cpu'] = formdata['cpu']
-        cpu = ''.join(formdata['cpu'])
-        self.cpu_guarantee = 1.
-        self.cpu_limit = float(cpu)
-
-        options['mem'] = formdata['mem']
-        memory = ''.join(formdata['mem'])
-        self.mem_guarantee = "2G"
-        self.mem_limit = memory
-
-        accelerator = "".join(formdata['gpu'])
-        if accelerator in ["none"]:
-          self.node_affinity_preferred = [
-            _prefer_accelerator(
-              acc.get('node_selector', {'accelerator': acc.get('name')}), 
-              weight=acc.get('preference_weight', 50)
-              )
-            for acc in GPU_MODEL_DESCRIPTION
-            ]
+      nodes = await _list_accelerator_nodes()
 
-        elif accelerator.startswith('gpu:'):
-          options['gpu'] = True
+      pods = []
+      if status_key in ['allocated']:
+        pods = await _list_scheduled_pods(namespace=JHUB_NAMESPACE)
 
-          _, model_gpu, n_gpus = accelerator.split(":")
-          gpu_data = {g['name']: g for g in GPU_MODEL_DESCRIPTION}.get(model_gpu)
-          if gpu_data is None:
-            raise Exception(f"Failed retrieving data for GPU model {model_gpu}")
+      return count_accelerators(
+        GPU_MODEL_DESCRIPTION, 
+        nodes, 
+        pods, 
+        status_key=status_key, 
+        default_extended_resource=default_extended_resource,
+      )
+      
 
-          ext_res = gpu_data.get('extended_resource', 'nvidia.com/gpu')
-          self.extra_resource_guarantees = {ext_res: n_gpus}
-          self.extra_resource_limits = {ext_res: n_gpus}
+    async def options_from_form(self, formdata):
+        for usage in self.get_storage_usage():
+          if usage['exceeded']:
+            logging.warning(
+              f"{self.get_user_name()} spawning with {usage['name']} using {usage['used_gb']:.1f} GB, "
+              f"beyond the soft limit of {usage['limit_gb']:.1f} GB"
+            )
 
-          self.tolerations.append(
-            {"key": f"nvidia.com/gpu", "operator": "Exists", "effect": "PreferNoSchedule"}
-          )
+        self.pod_profile, (options, spawner_config) = pod_profile_template(formdata)
+        print("SPAWN: " + spawner_config['image'] + " IMAGE" )
 
-          self.node_affinity_preferred = [
-            _prefer_accelerator(
-              gpu_data.get('node_selector', {'accelerator': gpu_data.get('name')}), 
-              weight=100
-              )
-          ]
+        for key, value in spawner_config.items():
+          if key == 'tolerations':
+            self.tolerations = self.tolerations + [t for t in value if t not in self.tolerations]
+          else:
+            setattr(self, key, value)
 
         logging.info("Affinity - preferred")
         logging.info(self.node_affinity_preferred)
-        return options
+        return dict(options)
 
     #################################################################################
     #### SPLASH AND AUTHORIZATION
@@ -385,11 +721,85 @@ class InfnSpawner(KubeSpawner):
     def get_user_storage(self):
       return [group.properties.get("storage") for group in self.user.groups if "storage" in group.properties] 
 
-    def check_priviledge(self, op):
-      system_groups = [g.name for g in self.user.groups if g.properties.get("system", False)] 
-      result = op in system_groups
-      logging.info(f"{self.get_user_name()} { 'has' if result else 'has not' } permission '{op}'")
-      return result
+    def get_user_privileges(self):
+      return [group.name for group in self.user.groups if group.properties.get("system", False)] 
+
+    #################################################################################
+    #### POD PATCH
+    #### ---------
+    #### The user-dependent data used to describe the pod are collected once per spawn.
+
+    @property
+    def pod_patch(self):
+      if getattr(self, "_pod_patch", None) is None:
+        self._pod_patch = PodPatch(
+          username=self.get_user_name(),
+          groups=tuple(self.get_user_groups()),
+          privileges=tuple(sorted(self.get_user_privileges())),
+          storage=tuple(self.get_user_storage()),
+        )
+        logging.info(f"{self._pod_patch.username} has permissions: {', '.join(self._pod_patch.privileges)}")
+
+      return self._pod_patch
+
+    def record_pod_patch(self):
+      """
+      Log the profile and the user patch which, with the configuration and the auth 
+      tokens, determine the pod manifest, and annotate the pod with their digest.
+      """
+      self._pod_patch = None
+      record = json.dumps(
+        dict(
+          profile=getattr(self, "pod_profile", None),
+          patch=self.pod_patch._asdict(),
+        ),
+        sort_keys=True,
+      )
+      record_digest = hashlib.sha256(record.encode()).hexdigest()[:16]
+      logging.info(f"Pod patch {record_digest}: {record}")
+      self.extra_annotations = {**self.extra_annotations, "ai-infn/pod-record": record_digest}
+
+    #################################################################################
+    #### STORAGE USAGE
+    #### -------------
+
+    def get_user_nfs_trees(self):
+      return [f"user-{self.get_user_name()}"] + [f"shared-{group}" for group in self.get_user_groups()]
+
+    def get_storage_usage(self):
+      """
+      Usage of the NFS trees mounted by the user, as indexed in background by 
+      the NfsUsageIndexer. Empty if the indexer is disabled.
+      """
+      if nfs_usage_indexer is None:
+        return []
+
+      storage_usage = []
+      for tree in self.get_user_nfs_trees():
+        used = nfs_usage_indexer.usage(tree)
+        limit = nfs_usage_indexer.soft_limit(tree)
+        storage_usage.append(
+          dict(
+            name=tree,
+            used_gb=None if used is None else used / 1e9,
+            limit_gb=None if limit is None else limit / 1e9,
+            exceeded=used is not None and limit is not None and used > limit,
+          )
+        )
+
+      return storage_usage
+
+    def mark_storage_active(self):
+      if nfs_usage_indexer is not None:
+        for tree in self.get_user_nfs_trees():
+          nfs_usage_indexer.mark_active(tree)
+
+    async def poll(self):
+      status = await KubeSpawner.poll(self)
+      if status is None and nfs_usage_indexer is not None:
+        for tree in self.get_user_nfs_trees():
+          nfs_usage_indexer.mark_running(tree)
+      return status
 
     #################################################################################
     #### VOLUMES
@@ -440,7 +850,7 @@ class InfnSpawner(KubeSpawner):
       
     @property 
     def volumes(self):
-      username = self.get_user_name()
+      patch = self.pod_patch
 
       volumes = [
         self.empty_volume('secret-mask'),
@@ -448,38 +858,38 @@ class InfnSpawner(KubeSpawner):
 
       if NFS_SERVER_ADDRESS is not None:
         volumes += [
-          self.nfs_volume(f'user-{username}'),
+          self.nfs_volume(f'user-{patch.username}'),
           self.nfs_volume(f'public'),
           self.nfs_volume(f'envs'),
           ]
 
         for volume in SYSTEM_VOLUMES:
-          if self.check_priviledge(volume):
+          if volume in patch.privileges:
             volumes.append(self.nfs_volume(volume))
 
-        for group in self.get_user_groups():
+        for group in patch.groups:
           volumes += [self.nfs_volume(f'shared-{group}')]
 
       return volumes
 
     @property 
     def volume_mounts (self):
-      username = self.get_user_name()
+      patch = self.pod_patch
       volumes = [
         {"name": "secret-mask", "mountPath": "/var/run/secrets/kubernetes.io/serviceaccount", "readOnly": True},
       ]
       if NFS_SERVER_ADDRESS is not None:
         volumes += [
-          {"name": f"user-{username}", "mountPath": f"/{HOME_NAME}/private"},
+          {"name": f"user-{patch.username}", "mountPath": f"/{HOME_NAME}/private"},
           {"name": "public", "mountPath": f"/{HOME_NAME}/shared/public"},
-          {"name": "envs", "mountPath": "/envs", "readOnly": not self.check_priviledge("envs")},
+          {"name": "envs", "mountPath": "/envs", "readOnly": "envs" not in patch.privileges},
           ]
 
         for volume in SYSTEM_VOLUMES:
-          if self.check_priviledge(volume):
+          if volume in patch.privileges:
             volumes += [{"name": volume, "mountPath": f"/{HOME_NAME}/system/{volume}"}]
 
-        for group in self.get_user_groups():
+        for group in patch.groups:
           volumes += [{"name": f"shared-{group}", "mountPath": f"/{HOME_NAME}/shared/{group}", "readOnly": False}]
 
       return volumes
@@ -490,7 +900,7 @@ class InfnSpawner(KubeSpawner):
     
     @property
     def lifecycle_hooks(self):
-        storage = self.get_user_storage()
+        storage = list(self.pod_patch.storage)
         if NFS_SERVER_ADDRESS is not None:
             return {
                 "postStart": {
@@ -530,14 +940,15 @@ class InfnSpawner(KubeSpawner):
       Configure a sidecar container for dispatching jobs via kueue,
       possibly using a virtual kueblet
       """
+      patch = self.pod_patch
       environment=dict(
         BRANCH=VKD_IMAGE_BRANCH, 
         INTERVAL="60",
-        JUPYTERHUB_USERNAME=str(self.get_user_name()),
-        JUPYTERHUB_GROUPS=":".join(self.get_user_groups()),
-        ADMIN="true" if self.check_priviledge(VKD_ADMIN_USER_GROUP) else "",
+        JUPYTERHUB_USERNAME=str(patch.username),
+        JUPYTERHUB_GROUPS=":".join(patch.groups),
+        ADMIN="true" if VKD_ADMIN_USER_GROUP in patch.privileges else "",
         PORT=str(VKD_PORT),
-        HTTP_PREFIX=f"/user/{self.get_user_name()}/proxy/{VKD_PORT}",
+        HTTP_PREFIX=f"/user/{patch.username}/proxy/{VKD_PORT}",
         MINIO_SERVER=VKD_MINIO_URL, 
         NAMESPACE=VKD_NAMESPACE,
         ORIGIN_NAMESPACE=JHUB_NAMESPACE,
@@ -576,6 +987,8 @@ class InfnSpawner(KubeSpawner):
     ####    container.
 
     async def _start(self):
+        self.record_pod_patch()
+        self.mark_storage_active()
         try:
           await self._config_ssh_service()
         except:
@@ -586,6 +999,7 @@ class InfnSpawner(KubeSpawner):
 
 
     async def stop(self, now=False):
+        self.mark_storage_active()
         try:
           await self._delete_ssh_service()
         except:
@@ -662,6 +1076,18 @@ c.GenericOAuthenticator.enable_auth_state = True
 c.JupyterHub.spawner_class = InfnSpawner
 InfnSpawner.initialize_nfs_volumes()
 
+nfs_usage_indexer = None
+if NFS_SERVER_ADDRESS is not None and NFS_USAGE_INDEXER:
+  nfs_usage_indexer = NfsUsageIndexer(
+    NFS_MOUNT_POINT,
+    refresh_interval=NFS_USAGE_REFRESH_INTERVAL,
+    full_rescan_interval=NFS_USAGE_FULL_RESCAN_INTERVAL,
+    max_workers=NFS_USAGE_MAX_WORKERS,
+    max_entries_per_second=NFS_USAGE_MAX_ENTRIES_PER_SECOND,
+    soft_limits_gb=NFS_USAGE_SOFT_LIMITS_GB,
+  )
+  nfs_usage_indexer.start()
+
 c.KubeSpawner.cmd = ["jupyterhub-singleuser"]
 c.KubeSpawner.args = ["--allow-root"]
 c.KubeSpawner.privileged = True
@@ -690,15 +1116,6 @@ c.JupyterHub.hub_connect_ip = 'hub.default.svc.cluster.local'
 c.KubeSpawner.notebook_dir = f"/{HOME_NAME}"
 c.KubeSpawner.default_url = "/lab"
 
-c.KubeSpawner.extra_container_config = {
-    "securityContext": {
-            "privileged": True,
-            "capabilities": {
-                        "add": ["SYS_ADMIN"]
-                    }
-        }
-}
-
 c.KubeSpawner.http_timeout = START_TIMEOUT
 c.KubeSpawner.start_timeout = START_TIMEOUT
 
@@ -726,8 +1143,8 @@ async def aiinfn_option_form (self):
       return jinja2.Template(f.read()).render(
         splash_message=self.splash_manager.message(**id_vars),
         **id_vars,
-        cpus=[1, 2, 3, 4, 8],
-        mem_sizes=[2, 4, 8],
+        cpus=SPAWN_FORM_CPUS,
+        mem_sizes=SPAWN_FORM_MEM_SIZES,
         accelerators=[
           dict(
               type="gpu",
@@ -741,6 +1158,7 @@ async def aiinfn_option_form (self):
         images = [
           dict(name=v, desc=k) for k, v in DEFAULT_JLAB_IMAGES.items()
         ],
+        storage_usage=self.get_storage_usage(),
       )
 
 c.KubeSpawner.options_form = aiinfn_option_form
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Placement logic of the InfnSpawner, free of any dependency on JupyterHub and
+on the Kubernetes APIs, shared by customconfig.py and placement_simulator.py.
+"""
+from typing import Dict, List, Literal, NamedTuple, Tuple
+
+
+class NodeRecord(NamedTuple):
+    """
+    Compact projection of a V1Node as used to count accelerators.
+    """
+    name: str
+    accelerator: str
+    allocatable: Dict[str, str]
+    capacity: Dict[str, str]
+
+
+class PodRecord(NamedTuple):
+    """
+    Compact projection of a V1Pod: the node it is scheduled on and
+    the resources (limits, falling back to requests) of each container.
+    """
+    node_name: str
+    resources: List[Dict[str, str]]
+
+
+def prefer_accelerator(node_selectors: Dict[str, str], weight=1):
+    """
+    Format the preference for an accelerator as an nodeAffinity preference.
+    """
+    return dict(
+        weight=weight,
+        preference=dict(
+            matchExpressions=[
+                {'key': label, 'operator': "In", "values": [value]}
+                for label, value in node_selectors.items()
+                ]
+            )
+        )
+
+
+def spawn_config_from_form(formdata, gpu_models: List[Dict]) -> Tuple[Dict, Dict]:
+    """
+    Translate the spawn form into the options stored by JupyterHub and the
+    KubeSpawner attributes to set (`tolerations` are to be appended).
+    """
+    options = {}
+    config = {}
+
+    options['img'] = formdata['img']
+    config['image'] = ''.join(formdata['img'])
+
+    options['cpu'] = formdata['cpu']
+    cpu = ''.join(formdata['cpu'])
+    config['cpu_guarantee'] = 1.
+    config['cpu_limit'] = float(cpu)
+
+    options['mem'] = formdata['mem']
+    memory = ''.join(formdata['mem'])
+    config['mem_guarantee'] = "2G"
+    config['mem_limit'] = memory
+
+    accelerator = "".join(formdata['gpu'])
+    if accelerator in ["none"]:
+        config['node_affinity_preferred'] = [
+            prefer_accelerator(
+                acc.get('node_selector', {'accelerator': acc.get('name')}), 
+                weight=acc.get('preference_weight', 50)
+                )
+            for acc in gpu_models
+            ]
+
+    elif accelerator.startswith('gpu:'):
+        options['gpu'] = True
+
+        _, model_gpu, n_gpus = accelerator.split(":")
+        gpu_data = {g['name']: g for g in gpu_models}.get(model_gpu)
+        if gpu_data is None:
+            raise Exception(f"Failed retrieving data for GPU model {model_gpu}")
+
+        ext_res = gpu_data.get('extended_resource', 'nvidia.com/gpu')
+        config['extra_resource_guarantees'] = {ext_res: n_gpus}
+        config['extra_resource_limits'] = {ext_res: n_gpus}
+
+        config['tolerations'] = [
+            {"key": f"nvidia.com/gpu", "operator": "Exists", "effect": "PreferNoSchedule"}
+        ]
+
+        config['node_affinity_preferred'] = [
+            prefer_accelerator(
+                gpu_data.get('node_selector', {'accelerator': gpu_data.get('name')}), 
+                weight=100
+                )
+        ]
+
+    return options, config
+
+
+def count_accelerators(
+    gpu_models: List[Dict],
+    nodes: List[NodeRecord],
+    pods: List[PodRecord],
+    status_key: Literal["allocated", "allocatable", "capacity"] = "allocatable",
+    default_extended_resource: str = "nvidia.com/gpu",
+    ):
+    """
+    Return the list `gpu_models` with an additional `count` key reporting the
+    number of each accelerator model either installed on the `nodes` 
+    (allocatable, capacity) or requested by the `pods` (allocated).
+
+    The model `name` must match the `accelerator` label of the node.
+    """
+    return_list = [dict(**acc, count=0) for acc in gpu_models]
+
+    if status_key in ['allocatable', 'capacity']:
+        for node in nodes:
+            for return_item in return_list:
+                if node.accelerator == return_item['name']:
+                    ext_res = return_item.get("extended_resource", default_extended_resource)
+                    node_count = getattr(node, status_key).get(ext_res, 0)
+                    return_item['count'] += int(node_count)
+
+    elif status_key in ['allocated']:
+        node_dict = {node.name: node for node in nodes}
+
+        for pod in pods:
+            node = node_dict.get(pod.node_name)
+            if node is None:
+                # Pod running on a node without accelerators
+                continue
+
+            for return_item in return_list:
+                if node.accelerator == return_item['name']:
+                    ext_res = return_item.get("extended_resource", default_extended_resource)
+                    for container_resources in pod.resources:
+                        return_item['count'] += int(container_resources.get(ext_res, 0))
+
+    else:
+        raise KeyError(f"Unexpected status_key {status_key}")
+
+    return return_list
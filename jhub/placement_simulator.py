@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline capacity simulator for the accelerator placement policies.
+
+Replays a trace of spawn/stop events against a modeled node inventory, translating
+each spawn with the same code used by the InfnSpawner (placement.py) and placing it
+with a simplified model of the kube-scheduler. Reports queueing delay, rejection rate
+and per-model utilization, to compare `preference_weight` values,
+`acceleratorKnownModels` mixes and hardware purchases before touching the cluster.
+
+Usage:
+    python placement_simulator.py --inventory inventory.yaml [--values ../values.yaml]
+        [--trace trace.jsonl | --synthetic 10000] [--json]
+
+The inventory is a YAML list of node groups:
+    - name: a100
+      count: 2
+      labels: {accelerator: a100}
+      allocatable: {cpu: 64, memory: 512Gi, nvidia.com/gpu: 7}
+      taints: [{key: nvidia.com/gpu, effect: PreferNoSchedule}]
+
+The trace is a JSON-lines file of events, sorted or not, with times in seconds.
+Spawns may define the `duration` of the session instead of an explicit stop:
+    {"time": 0, "user": "alice", "action": "spawn", "gpu": "gpu:t4:1", "cpu": "2", "mem": "4G"}
+    {"time": 3600, "user": "alice", "action": "stop"}
+
+Scheduler model. A node is feasible if it has enough allocatable cpu, memory and
+extended resources left for the requests (guarantees) of the pod and if all its
+NoSchedule and NoExecute taints are tolerated. Feasible nodes are scored as the sum
+of the normalized NodeAffinity, TaintToleration and NodeResourcesFit (LeastAllocated)
+scores, as the default kube-scheduler profile does. Pods that cannot be placed are
+queued and rejected if still pending after the start timeout.
+"""
+import os
+import sys
+import json
+import heapq
+import random
+import argparse
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from placement import (
+    NodeRecord,
+    PodRecord,
+    spawn_config_from_form,
+    count_accelerators,
+)
+
+
+_QUANTITY_SUFFIXES = {
+    'Ki': 1024, 'Mi': 1024**2, 'Gi': 1024**3, 'Ti': 1024**4, 'Pi': 1024**5,
+    'k': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15,
+    'm': 1e-3,
+}
+
+
+def parse_quantity(quantity) -> float:
+    """
+    Parse a Kubernetes resource quantity (e.g. "2G", "512Mi", "500m", 4) as a float.
+    """
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+
+    quantity = str(quantity).strip()
+    for suffix in sorted(_QUANTITY_SUFFIXES, key=len, reverse=True):
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * _QUANTITY_SUFFIXES[suffix]
+    return float(quantity)
+
+
+class SimNode:
+    """
+    A node of the modeled inventory, with the resources requested by the pods it hosts.
+    """
+    __slots__ = ('name', 'labels', 'allocatable', 'used', 'taints', 'record')
+
+    def __init__(self, name: str, labels: Dict[str, str], allocatable: Dict, taints: List[Dict]):
+        self.name = name
+        self.labels = labels
+        self.allocatable = {k: parse_quantity(v) for k, v in allocatable.items()}
+        self.used = defaultdict(float)
+        self.taints = taints
+        self.record = NodeRecord(
+            name=name,
+            accelerator=labels.get('accelerator', 'none'),
+            allocatable={k: str(v) for k, v in allocatable.items()},
+            capacity={k: str(v) for k, v in allocatable.items()},
+        )
+
+    def fits(self, requests: Dict[str, float]) -> bool:
+        return all(
+            self.used[resource] + amount <= self.allocatable.get(resource, 0.)
+            for resource, amount in requests.items()
+        )
+
+    def free_fraction(self, resource: str, requests: Dict[str, float]) -> float:
+        allocatable = self.allocatable.get(resource, 0.)
+        if allocatable <= 0:
+            return 0.
+        return max(0., allocatable - self.used[resource] - requests.get(resource, 0.)) / allocatable
+
+
+class SpawnRequest(NamedTuple):
+    user: str
+    time: float
+    gpu: str
+    model: Optional[str]
+    requests: Dict[str, float]
+    limits: Dict[str, str]
+    tolerations: List[Dict]
+    node_affinity_preferred: List[Dict]
+    duration: Optional[float]
+
+
+def _tolerates(tolerations: List[Dict], taint: Dict) -> bool:
+    for toleration in tolerations:
+        if toleration.get('effect') not in (None, '', taint.get('effect')):
+            continue
+        if toleration.get('operator', 'Equal') == 'Exists':
+            if toleration.get('key') in (None, taint.get('key')):
+                return True
+        elif toleration.get('key') == taint.get('key') and toleration.get('value') == taint.get('value'):
+            return True
+    return False
+
+
+def _matches(preference: Dict, labels: Dict[str, str]) -> bool:
+    for expression in preference.get('matchExpressions', []):
+        operator = expression['operator']
+        value = labels.get(expression['key'])
+        if operator == 'In' and value not in expression['values']:
+            return False
+        if operator == 'NotIn' and value in expression['values']:
+            return False
+        if operator == 'Exists' and value is None:
+            return False
+        if operator == 'DoesNotExist' and value is not None:
+            return False
+    return True
+
+
+class PlacementSimulator:
+    """
+    Discrete-event simulation of the spawns and stops of a trace on a node inventory.
+    """
+    def __init__(
+        self,
+        nodes: List[SimNode],
+        gpu_models: List[Dict],
+        start_timeout: float = 20.,
+        default_extended_resource: str = "nvidia.com/gpu",
+    ):
+        self.nodes = nodes
+        self.gpu_models = gpu_models
+        self.start_timeout = start_timeout
+        self.default_extended_resource = default_extended_resource
+
+        node_records = [node.record for node in nodes]
+        self.offered = {
+            acc['name']: acc['count']
+            for acc in count_accelerators(
+                gpu_models, node_records, [], "allocatable", default_extended_resource
+            )
+        }
+
+        # (model, extended resource) pairs accounted on each node, as in count_accelerators
+        self._node_models = {
+            node.name: [
+                (acc['name'], acc.get('extended_resource', default_extended_resource))
+                for acc in gpu_models if acc['name'] == node.record.accelerator
+            ]
+            for node in nodes
+        }
+
+        self._spawn_configs = {}
+        self._affinity_scores = {}
+        self._taint_counts = {}
+
+        self._events = []
+        self._sequence = 0
+        self._now = 0.
+        self._running = {}      # user -> (SpawnRequest, SimNode)
+        self._pending = {}      # user -> SpawnRequest, in arrival order
+
+        self._allocated = defaultdict(float)
+        self._allocated_area = defaultdict(float)
+        self._start_time = None
+        self._trace_end = None      # time of the last spawn or stop of the trace
+
+        self.stats = defaultdict(int, dict.fromkeys([
+            'events', 'spawns', 'stops', 'placed', 'cancelled', 'duplicate_spawns',
+            'rejected_timeout', 'rejected_unavailable',
+            'placed_on_other_model', 'cpu_only_on_accelerator_nodes',
+        ], 0))
+        self.queue_delays = []
+        self.model_spawns = defaultdict(int)
+        self.model_rejections = defaultdict(int)
+
+    ############################################################################
+    ## Trace
+    def push(self, when: float, action: str, payload: Dict):
+        heapq.heappush(self._events, (float(when), self._sequence, action, payload))
+        self._sequence += 1
+
+    def load_trace(self, events):
+        for event in events:
+            self.push(event['time'], event['action'], event)
+            self._trace_end = max(self._trace_end or float(event['time']), float(event['time']))
+
+    ############################################################################
+    ## Translation of the spawn form
+    def spawn_request(self, event: Dict) -> SpawnRequest:
+        key = (str(event.get('cpu', '1')), str(event.get('mem', '2G')), event.get('gpu', 'none'))
+        if key not in self._spawn_configs:
+            formdata = dict(img=[event.get('img', 'simulated')], cpu=[key[0]], mem=[key[1]], gpu=[key[2]])
+            _, config = spawn_config_from_form(formdata, self.gpu_models)
+            requests = {
+                'cpu': parse_quantity(config['cpu_guarantee']),
+                'memory': parse_quantity(config['mem_guarantee']),
+            }
+            for resource, amount in config.get('extra_resource_guarantees', {}).items():
+                requests[resource] = parse_quantity(amount)
+
+            model = key[2].split(":")[1] if key[2].startswith("gpu:") else None
+            self._spawn_configs[key] = (model, requests, config)
+
+        model, requests, config = self._spawn_configs[key]
+        return SpawnRequest(
+            user=event['user'],
+            time=self._now,
+            gpu=key[2],
+            model=model,
+            requests=requests,
+            limits=config.get('extra_resource_limits', {}),
+            tolerations=config.get('tolerations', []),
+            node_affinity_preferred=config.get('node_affinity_preferred', []),
+            duration=event.get('duration'),
+        )
+
+    ############################################################################
+    ## Scheduler model
+    def _static_scores(self, request: SpawnRequest):
+        """
+        NodeAffinity and TaintToleration raw scores only depend on the node labels
+        and taints and on the spawn form, cache them per accelerator option.
+        """
+        if request.gpu not in self._affinity_scores:
+            self._affinity_scores[request.gpu] = [
+                sum(
+                    term['weight'] for term in request.node_affinity_preferred
+                    if _matches(term['preference'], node.labels)
+                )
+                for node in self.nodes
+            ]
+            self._taint_counts[request.gpu] = [
+                sum(
+                    1 for taint in node.taints
+                    if taint.get('effect') == 'PreferNoSchedule'
+                    and not _tolerates(request.tolerations, taint)
+                )
+                for node in self.nodes
+            ]
+        return self._affinity_scores[request.gpu], self._taint_counts[request.gpu]
+
+    def _feasible(self, node: SimNode, request: SpawnRequest) -> bool:
+        for taint in node.taints:
+            if taint.get('effect') in ('NoSchedule', 'NoExecute') and not _tolerates(request.tolerations, taint):
+                return False
+        return node.fits(request.requests)
+
+    def select_node(self, request: SpawnRequest) -> Optional[SimNode]:
+        affinity_scores, taint_counts = self._static_scores(request)
+        feasible = [i for i, node in enumerate(self.nodes) if self._feasible(node, request)]
+        if len(feasible) == 0:
+            return None
+
+        max_affinity = max(affinity_scores[i] for i in feasible)
+        max_taints = max(taint_counts[i] for i in feasible)
+
+        def score(i):
+            node = self.nodes[i]
+            affinity = 100. * affinity_scores[i] / max_affinity if max_affinity > 0 else 0.
+            toleration = 100. * (1 - taint_counts[i] / max_taints) if max_taints > 0 else 100.
+            least_allocated = 50. * (
+                node.free_fraction('cpu', request.requests) +
+                node.free_fraction('memory', request.requests)
+            )
+            return affinity + toleration + least_allocated
+
+        return self.nodes[max(feasible, key=score)]
+
+    ############################################################################
+    ## Accounting
+    def _advance(self, when: float):
+        if self._start_time is None:
+            self._start_time = when
+        # Utilization is integrated over the trace only, not over the final drain
+        elapsed = min(when, self._trace_end or when) - self._now
+        if elapsed > 0:
+            for model, allocated in self._allocated.items():
+                self._allocated_area[model] += allocated * elapsed
+        self._now = max(self._now, when)
+
+    def _account(self, node: SimNode, request: SpawnRequest, sign: int):
+        for resource, amount in request.requests.items():
+            node.used[resource] += sign * amount
+        for model, ext_res in self._node_models[node.name]:
+            self._allocated[model] += sign * parse_quantity(request.limits.get(ext_res, 0))
+
+    def _place(self, request: SpawnRequest) -> bool:
+        node = self.select_node(request)
+        if node is None:
+            return False
+
+        self._account(node, request, +1)
+        self._running[request.user] = (request, node)
+        self.queue_delays.append(self._now - request.time)
+        self.stats['placed'] += 1
+
+        if request.model is not None and node.record.accelerator != request.model:
+            self.stats['placed_on_other_model'] += 1
+        if request.model is None and node.record.accelerator != 'none':
+            self.stats['cpu_only_on_accelerator_nodes'] += 1
+
+        if request.duration is not None:
+            self.push(self._now + float(request.duration), 'stop', dict(user=request.user))
+        return True
+
+    def _retry_pending(self):
+        for user, request in list(self._pending.items()):
+            if self._place(request):
+                del self._pending[user]
+
+    ############################################################################
+    ## Event handlers
+    def on_spawn(self, event: Dict):
+        user = event['user']
+        if user in self._running or user in self._pending:
+            self.stats['duplicate_spawns'] += 1
+            return
+
+        self.stats['spawns'] += 1
+        gpu = event.get('gpu', 'none')
+        if gpu.startswith('gpu:') and gpu.split(":")[1] not in self.offered:
+            # Accelerator model not in the acceleratorKnownModels under test
+            model = gpu.split(":")[1]
+            self.model_spawns[model] += 1
+            self.stats['rejected_unavailable'] += 1
+            self.model_rejections[model] += 1
+            return
+
+        request = self.spawn_request(event)
+        self.model_spawns[request.model or 'none'] += 1
+
+        if request.model is not None and self.offered.get(request.model, 0) == 0:
+            # Not listed in the spawn form
+            self.stats['rejected_unavailable'] += 1
+            self.model_rejections[request.model] += 1
+            return
+
+        if not self._place(request):
+            self._pending[user] = request
+            self.push(self._now + self.start_timeout, 'timeout', dict(user=user, spawn_time=request.time))
+
+    def on_stop(self, event: Dict):
+        user = event['user']
+        if user in self._pending:
+            del self._pending[user]
+            self.stats['cancelled'] += 1
+            return
+
+        if user not in self._running:
+            return
+
+        request, node = self._running.pop(user)
+        self._account(node, request, -1)
+        self.stats['stops'] += 1
+        self._retry_pending()
+
+    def on_timeout(self, event: Dict):
+        request = self._pending.get(event['user'])
+        if request is not None and request.time == event['spawn_time']:
+            del self._pending[event['user']]
+            self.stats['rejected_timeout'] += 1
+            self.model_rejections[request.model or 'none'] += 1
+
+    def run(self):
+        handlers = dict(spawn=self.on_spawn, stop=self.on_stop, timeout=self.on_timeout)
+        while self._events:
+            when, _, action, payload = heapq.heappop(self._events)
+            self._advance(when)
+            handlers[action](payload)
+            self.stats['events'] += 1
+        return self
+
+    ############################################################################
+    ## Report
+    def report(self) -> Dict:
+        duration = self._now - (self._start_time or 0.)
+        trace_duration = (self._trace_end or 0.) - (self._start_time or 0.)
+        delays = sorted(self.queue_delays)
+
+        def percentile(q):
+            if len(delays) == 0:
+                return None
+            return delays[min(len(delays) - 1, int(q * len(delays)))]
+
+        running_pods = [
+            PodRecord(node_name=node.name, resources=[request.limits])
+            for request, node in self._running.values()
+        ]
+        allocated_at_end = {
+            acc['name']: acc['count']
+            for acc in count_accelerators(
+                self.gpu_models, [node.record for node in self.nodes], running_pods,
+                "allocated", self.default_extended_resource,
+            )
+        }
+
+        spawns = self.stats['spawns']
+        rejected = self.stats['rejected_timeout'] + self.stats['rejected_unavailable']
+        report = dict(
+            simulated_hours=duration / 3600.,
+            trace_hours=trace_duration / 3600.,
+            **self.stats,
+            rejection_rate=rejected / spawns if spawns else 0.,
+            queue_delay=dict(
+                mean=sum(delays) / len(delays) if delays else None,
+                p50=percentile(0.50),
+                p95=percentile(0.95),
+                max=delays[-1] if delays else None,
+            ),
+            models={
+                acc['name']: dict(
+                    offered=self.offered.get(acc['name'], 0),
+                    spawns=self.model_spawns.get(acc['name'], 0),
+                    rejections=self.model_rejections.get(acc['name'], 0),
+                    utilization=(
+                        self._allocated_area[acc['name']] / (self.offered[acc['name']] * trace_duration)
+                        if self.offered.get(acc['name']) and trace_duration > 0 else None
+                    ),
+                    allocated_at_end=allocated_at_end.get(acc['name'], 0),
+                )
+                for acc in self.gpu_models
+            },
+        )
+        known_models = {acc['name'] for acc in self.gpu_models} | {'none'}
+        for name in self.model_spawns.keys() - known_models:
+            report['models'][name] = dict(
+                offered=0,
+                spawns=self.model_spawns[name],
+                rejections=self.model_rejections[name],
+                utilization=None,
+                allocated_at_end=0,
+            )
+        return report
+
+
+################################################################################
+## Inputs
+def load_inventory(path: Path) -> List[SimNode]:
+    with open(path) as f:
+        groups = yaml.safe_load(f)
+
+    nodes = []
+    for group in groups:
+        for i in range(int(group.get('count', 1))):
+            nodes.append(
+                SimNode(
+                    name=f"{group['name']}-{i}",
+                    labels=group.get('labels') or {},
+                    allocatable=group.get('allocatable') or {},
+                    taints=group.get('taints') or [],
+                )
+            )
+    return nodes
+
+
+def load_trace(path: Path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def synthetic_trace(
+    n_sessions: int,
+    gpu_models: List[Dict],
+    rate_per_hour: float = 20.,
+    mean_duration_hours: float = 4.,
+    mix: Optional[Dict[str, float]] = None,
+    seed: int = 0,
+):
+    """
+    Poisson arrivals of sessions of exponentially distributed duration. The `mix` maps
+    the accelerator options of the spawn form (e.g. "none", "gpu:t4:1") to their weights,
+    by default half CPU-only sessions and half evenly split on the GPU models among
+    `gpu_models`, which should be those offered by the spawn form.
+    """
+    rng = random.Random(seed)
+    if mix is None:
+        gpus = [acc['name'] for acc in gpu_models if acc.get('type') == 'gpu']
+        mix = {"none": 0.5, **{f"gpu:{name}:1": 0.5 / len(gpus) for name in gpus}} if gpus else {"none": 1.}
+
+    options, weights = zip(*mix.items())
+    now = 0.
+    for i_session in range(n_sessions):
+        now += rng.expovariate(rate_per_hour / 3600.)
+        yield dict(
+            time=now,
+            user=f"user{i_session}",
+            action="spawn",
+            gpu=rng.choices(options, weights)[0],
+            cpu=rng.choice(["1", "2", "4"]),
+            mem=rng.choice(["2G", "4G", "8G"]),
+            duration=rng.expovariate(1. / (mean_duration_hours * 3600.)),
+        )
+
+
+def print_report(report: Dict, events_per_second: float):
+    print(f"Simulated time:          {report['simulated_hours']:.1f} h ({events_per_second:.0f} events/s)")
+    print(f"Trace time:              {report['trace_hours']:.1f} h (utilization window)")
+    print(f"Spawns:                  {report['spawns']}")
+    print(f"Rejected (timeout):      {report['rejected_timeout']}")
+    print(f"Rejected (not offered):  {report['rejected_unavailable']}")
+    print(f"Rejection rate:          {100 * report['rejection_rate']:.2f}%")
+    print(f"GPU on other model:      {report['placed_on_other_model']}")
+    print(f"CPU-only on accel nodes: {report['cpu_only_on_accelerator_nodes']}")
+    delays = report['queue_delay']
+    if delays['mean'] is not None:
+        print(
+            f"Queueing delay [s]:      mean {delays['mean']:.1f}  p50 {delays['p50']:.1f}  "
+            f"p95 {delays['p95']:.1f}  max {delays['max']:.1f}"
+        )
+    print()
+    print(f"{'Model':<16s} {'Offered':>8s} {'Spawns':>8s} {'Rejected':>9s} {'Utilization':>12s}")
+    for name, model in report['models'].items():
+        utilization = "-" if model['utilization'] is None else f"{100 * model['utilization']:.1f}%"
+        print(f"{name:<16s} {model['offered']:>8d} {model['spawns']:>8d} {model['rejections']:>9d} {utilization:>12s}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--inventory", required=True, type=Path, help="YAML description of the nodes")
+    parser.add_argument(
+        "--values",
+        type=Path,
+        default=Path(__file__).resolve().parent.parent / "values.yaml",
+        help="Helm values defining acceleratorKnownModels and jhubStartTimeout",
+    )
+    parser.add_argument("--trace", type=Path, help="JSON-lines trace of spawn/stop events")
+    parser.add_argument("--synthetic", type=int, default=10000, help="Number of synthetic sessions if no trace")
+    parser.add_argument("--rate", type=float, default=20., help="Synthetic sessions per hour")
+    parser.add_argument("--mean-duration", type=float, default=4., help="Mean synthetic session duration (hours)")
+    parser.add_argument("--mix", type=json.loads, help='Synthetic accelerator mix, e.g. \'{"none": 0.6, "gpu:t4:1": 0.4}\'')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start-timeout", type=float, help="Override jhubStartTimeout (seconds)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    with open(args.values) as f:
+        values = yaml.safe_load(f)
+    gpu_models = values.get('acceleratorKnownModels') or []
+    start_timeout = args.start_timeout or float(values.get('jhubStartTimeout', 20))
+
+    simulator = PlacementSimulator(load_inventory(args.inventory), gpu_models, start_timeout=start_timeout)
+    if args.trace is not None:
+        simulator.load_trace(load_trace(args.trace))
+    else:
+        simulator.load_trace(
+            synthetic_trace(
+                args.synthetic,
+                [acc for acc in gpu_models if simulator.offered.get(acc['name'], 0) > 0],
+                args.rate, args.mean_duration, args.mix, args.seed,
+            )
+        )
+
+    start_time = time.perf_counter()
+    simulator.run()
+    events_per_second = simulator.stats['events'] / max(time.perf_counter() - start_time, 1e-9)
+
+    report = simulator.report()
+    if args.json:
+        print(json.dumps(dict(report, events_per_second=events_per_second), indent=2))
+    else:
+        print_report(report, events_per_second)
+
+
+if __name__ == "__main__":
+    main()